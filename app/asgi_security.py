@@ -0,0 +1,71 @@
+"""
+Pure ASGI security headers middleware shared by the startup scripts
+Чистое ASGI промежуточное ПО заголовков безопасности для скриптов запуска
+"""
+
+from typing import List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Raw ASGI header tuples, appended to responses without re-encoding
+BASIC_SECURITY_HEADERS: List[Tuple[bytes, bytes]] = [
+    (b"x-frame-options", b"DENY"),
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b"referrer-policy", b"strict-origin-when-cross-origin"),
+    (b"permissions-policy", b"camera=(), microphone=(), geolocation=()"),
+]
+
+CONTENT_SECURITY_POLICY: bytes = (
+    b"default-src 'self'; "
+    b"script-src 'self' 'unsafe-inline'; "
+    b"style-src 'self' 'unsafe-inline'; "
+    b"img-src 'self' data: https:; "
+    b"font-src 'self'; "
+    b"connect-src 'self'; "
+    b"object-src 'none'; "
+    b"base-uri 'self'; "
+    b"form-action 'self'"
+)
+
+SECURITY_HEADERS: List[Tuple[bytes, bytes]] = BASIC_SECURITY_HEADERS + [
+    (b"strict-transport-security", b"max-age=31536000; includeSubDomains"),
+    (b"cross-origin-opener-policy", b"same-origin"),
+    (b"cross-origin-resource-policy", b"same-origin"),
+    (b"content-security-policy", CONTENT_SECURITY_POLICY),
+]
+
+
+class SecurityHeadersASGIMiddleware:
+    """
+    Add security headers to every HTTP response and strip the server header
+    Добавление заголовков безопасности к каждому HTTP ответу и удаление заголовка server
+    """
+
+    def __init__(
+        self, app: ASGIApp, headers: Optional[List[Tuple[bytes, bytes]]] = None
+    ) -> None:
+        self.app = app
+        self.headers: List[Tuple[bytes, bytes]] = (
+            SECURITY_HEADERS if headers is None else headers
+        )
+        # Existing response headers replaced or stripped by this middleware
+        self.overridden = frozenset([b"server"] + [name for name, _ in self.headers])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = [
+                    (name, value)
+                    for name, value in message.get("headers", [])
+                    if name.lower() not in self.overridden
+                ]
+                headers.extend(self.headers)
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
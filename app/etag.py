@@ -0,0 +1,18 @@
+"""
+ETag hashing shared by the startup scripts
+Хеширование ETag, общее для скриптов запуска
+"""
+
+import hashlib
+
+# xxh3 when available, BLAKE2b otherwise (both avoid MD5)
+try:
+    import xxhash
+
+    def etag_hash(value: str) -> str:
+        return xxhash.xxh3_64_hexdigest(value)
+
+except ImportError:
+
+    def etag_hash(value: str) -> str:
+        return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
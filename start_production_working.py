@@ -4,17 +4,37 @@ FastAPI Security Proxy - Production Ready
 HTTP/2, ETag, Range requests, Security Headers, Prometheus metrics
 """
 
+import argparse
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response
+from app.asgi_security import SecurityHeadersASGIMiddleware
+from app.etag import etag_hash
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from fastapi.responses import (
+    FileResponse,
+    ORJSONResponse,
+    Response,
+    StreamingResponse,
+)
 from pathlib import Path
+import aiofiles
 import httpx
 import logging
-import hashlib
+import mimetypes
+import os
+import re
+import asyncio
+import collections
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from datetime import datetime
+from email.utils import formatdate
 import time
-from typing import Dict, Optional
+from typing import Any, Dict, NamedTuple, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -24,11 +44,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run background maintenance tasks for the lifetime of the app"""
+    await run_in_threadpool(load_static_memory_cache)
+    cache_task = asyncio.create_task(refresh_static_caches_periodically())
+    try:
+        yield
+    finally:
+        cache_task.cancel()
+
+
 # Create FastAPI app
 app = FastAPI(
     title="FastAPI Security Proxy",
     description="Production-ready security proxy with HTTP/2, ETag, and security headers",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # Configuration
@@ -36,7 +69,15 @@ TARGET_SERVER = "http://127.0.0.1:8097"
 STATIC_ROOT = Path("data/htdocs")
 HOST = "0.0.0.0"
 PORT = 8080
-WORKERS = 4
+WORKERS = max(2, os.cpu_count() or 4)
+STATIC_CACHE_TTL = 60  # seconds between static cache refreshes
+STATIC_MEMORY_MAX_SIZE = 64 * 1024  # files up to this size are served from memory
+STATIC_MEMORY_BUDGET = 8 * 1024 * 1024  # total bytes cached in memory per worker
+STATIC_MEMORY_PRELOAD = ("index.html",)  # cached first, ahead of hot files
+SSL_CERT_FILE = Path("certs/cert.pem")
+SSL_KEY_FILE = Path("certs/key.pem")
+RANGE_CHUNK_SIZE = 64 * 1024  # bytes per chunk when streaming Range responses
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
 
 # Create directories
 STATIC_ROOT.mkdir(parents=True, exist_ok=True)
@@ -110,7 +151,6 @@ try:
     )
 
     # Initialize metrics only in main process to avoid duplication
-    import os
     import multiprocessing
 
     # Check if we're in the main process (not a worker process)
@@ -136,61 +176,210 @@ except ImportError:
     logger.info("Prometheus client not available, metrics disabled")
 
 
-# Security headers middleware
-@app.middleware("http")
-async def security_headers_middleware(request: Request, call_next):
-    start_time = time.time()
+# Labelled request counters, cached to skip prometheus' label lookup
+_request_counters: Dict[Tuple[str, str, int], Any] = {}
 
-    # Track active requests if Prometheus available
-    if _prometheus_available and _active_requests:
-        _active_requests.inc()
 
-    try:
-        response = await call_next(request)
-
-        # Add security headers
-        security_headers = {
-            "X-Frame-Options": "DENY",
-            "X-Content-Type-Options": "nosniff",
-            "X-XSS-Protection": "1; mode=block",
-            "Referrer-Policy": "strict-origin-when-cross-origin",
-            "Permissions-Policy": "camera=(), microphone=(), geolocation=()",
-            "Strict-Transport-Security": "max-age=31536000; includeSubDomains",
-            "Cross-Origin-Opener-Policy": "same-origin",
-            "Cross-Origin-Resource-Policy": "same-origin",
-        }
+class MetricsMiddleware:
+    """Pure ASGI middleware recording Prometheus request metrics"""
 
-        # Content Security Policy
-        csp = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline'; "
-            "style-src 'self' 'unsafe-inline'; "
-            "img-src 'self' data: https:; "
-            "font-src 'self'; "
-            "connect-src 'self'; "
-            "object-src 'none'; "
-            "base-uri 'self'; "
-            "form-action 'self'"
-        )
-        response.headers["Content-Security-Policy"] = csp
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
 
-        for header, value in security_headers.items():
-            response.headers[header] = value
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not _prometheus_available:
+            await self.app(scope, receive, send)
+            return
 
-        # Remove server header
-        if "server" in response.headers:
-            del response.headers["server"]
+        start_time = time.perf_counter()
+        status_code = 500  # Reported if the app fails before responding
 
-        return response
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-    finally:
-        # Update metrics
-        if _prometheus_available and _active_requests and _request_duration:
+        _active_requests.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
             _active_requests.dec()
-            duration = time.time() - start_time
-            _request_duration.labels(
-                method=request.method, endpoint=request.url.path
-            ).observe(duration)
+            # Label by route template, not raw path, to bound cardinality
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            _request_duration.labels(method=method, endpoint=endpoint).observe(
+                time.perf_counter() - start_time
+            )
+
+            key = (method, endpoint, status_code)
+            counter = _request_counters.get(key)
+            if counter is None:
+                counter = _request_count.labels(
+                    method=method, endpoint=endpoint, status_code=str(status_code)
+                )
+                _request_counters[key] = counter
+            counter.inc()
+
+
+# Media types worth compressing; everything else is sent as-is
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+)
+GZIP_ETAG_SUFFIX = "-gzip"
+
+
+class CompressibleGZipResponder(GZipResponder):
+    """GZip responder that only touches full responses of compressible types"""
+
+    passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        async def send_with_validators(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                if headers.get("content-encoding") == "gzip":
+                    # The gzip copy is a distinct representation: own ETag,
+                    # and byte ranges would not address it
+                    if "etag" in headers:
+                        headers["ETag"] = headers["etag"] + GZIP_ETAG_SUFFIX
+                    if "accept-ranges" in headers:
+                        del headers["accept-ranges"]
+            await send(message)
+
+        await super().__call__(scope, receive, send_with_validators)
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.passthrough = message["status"] != 200 or not content_type.startswith(
+                COMPRESSIBLE_TYPES
+            )
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware gzip-compressing compressible 200 responses"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get(
+            "accept-encoding", ""
+        ):
+            responder = CompressibleGZipResponder(self.app, self.minimum_size)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+# Last added runs first: metrics wrap the security headers and compression
+app.add_middleware(CompressionMiddleware, minimum_size=1024)
+app.add_middleware(SecurityHeadersASGIMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+@lru_cache(maxsize=4096)
+def resolve_static_file(filename: str) -> Optional[Path]:
+    """Resolve a filename under STATIC_ROOT, or None if it is not a file"""
+    file_path = STATIC_ROOT / filename
+    return file_path if file_path.is_file() else None
+
+
+@lru_cache(maxsize=4096)
+def static_validators(name: str, mtime: float, size: int) -> Tuple[str, str]:
+    """ETag and Last-Modified for a file; recomputed only when it changes"""
+    return etag_hash(f"{name}-{mtime}-{size}"), formatdate(mtime, usegmt=True)
+
+
+async def iter_file_range(file_path: Path, start: int, length: int):
+    """Yield `length` bytes of a file from `start` in RANGE_CHUNK_SIZE chunks"""
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class CachedStaticFile(NamedTuple):
+    """Small static file held in memory with precomputed response headers"""
+
+    content: bytes
+    etag: str
+    media_type: str
+    headers: Dict[str, str]
+
+
+# Relative filename -> cached file; replaced wholesale on every refresh
+static_memory_cache: Dict[str, CachedStaticFile] = {}
+
+# Requests per static filename since the last refresh; picks the hot files
+static_hits: collections.Counter = collections.Counter()
+
+
+def load_static_memory_cache(hits: Optional[collections.Counter] = None) -> None:
+    """(Re)load preloaded and hot small files within STATIC_MEMORY_BUDGET"""
+    global static_memory_cache
+
+    hot = [name for name, _ in hits.most_common()] if hits else []
+    cache: Dict[str, CachedStaticFile] = {}
+    budget = STATIC_MEMORY_BUDGET
+    for name in dict.fromkeys([*STATIC_MEMORY_PRELOAD, *hot]):
+        file_path = resolve_static_file(name)
+        if file_path is None:
+            continue
+        try:
+            stat = file_path.stat()
+            if stat.st_size > STATIC_MEMORY_MAX_SIZE or stat.st_size > budget:
+                continue
+
+            etag, last_modified = static_validators(
+                file_path.name, stat.st_mtime, stat.st_size
+            )
+            cached = static_memory_cache.get(name)
+            if cached is None or cached.etag != etag:
+                cached = CachedStaticFile(
+                    content=file_path.read_bytes(),
+                    etag=etag,
+                    media_type=mimetypes.guess_type(name)[0] or "text/plain",
+                    headers={
+                        "Accept-Ranges": "bytes",
+                        "ETag": etag,
+                        "Cache-Control": "public, max-age=3600",
+                        "Last-Modified": last_modified,
+                    },
+                )
+            cache[name] = cached
+            budget -= len(cached.content)
+        except OSError as e:
+            logger.warning(f"Cannot cache static file {file_path}: {e}")
+
+    static_memory_cache = cache
+
+
+async def refresh_static_caches_periodically():
+    """Refresh static caches so new, changed and removed files become visible"""
+    global static_hits
+
+    while True:
+        await asyncio.sleep(STATIC_CACHE_TTL)
+        # Swap the counter on the event loop so the worker thread owns it
+        hits, static_hits = static_hits, collections.Counter()
+        resolve_static_file.cache_clear()
+        await run_in_threadpool(load_static_memory_cache, hits)
 
 
 async def proxy_request(request: Request, path: str = ""):
@@ -250,65 +439,78 @@ async def serve_static_files(request: Request, filename: str = ""):
     if not filename:
         filename = "index.html"
 
-    file_path = STATIC_ROOT / filename
+    # Hot path: small files served from memory (ranges go to disk)
+    cached = static_memory_cache.get(filename)
+    if cached is not None and "range" not in request.headers:
+        static_hits[filename] += 1
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match in (cached.etag, cached.etag + GZIP_ETAG_SUFFIX):
+            return Response(status_code=304, headers={"ETag": if_none_match})
+        return Response(
+            content=cached.content,
+            media_type=cached.media_type,
+            headers=cached.headers,
+        )
+
+    file_path = resolve_static_file(filename)
+
+    if file_path is not None:
+        static_hits[filename] += 1
 
-    if file_path.exists() and file_path.is_file():
         # Get file stats for ETag
-        stat = file_path.stat()
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            # Removed since it was cached
+            resolve_static_file.cache_clear()
+            return await proxy_request(request, filename)
         file_size = stat.st_size
-        last_modified = datetime.fromtimestamp(stat.st_mtime)
-
-        # Generate ETag
-        etag_content = f"{file_path.name}-{stat.st_mtime}-{file_size}"
-        etag = hashlib.md5(etag_content.encode()).hexdigest()
+        etag, last_modified = static_validators(
+            file_path.name, stat.st_mtime, file_size
+        )
 
-        # Check If-None-Match for cache validation
+        # Check If-None-Match for cache validation (plain or gzip copy)
         if_none_match = request.headers.get("if-none-match")
-        if if_none_match and if_none_match == etag:
-            return Response(status_code=304)
-
-        # Handle Range requests
-        range_header = request.headers.get("range")
-        if range_header and range_header.startswith("bytes="):
-            try:
-                range_spec = range_header[6:]  # Remove "bytes="
-                if "-" in range_spec:
-                    start_end = range_spec.split("-")
-                    if len(start_end) == 2:
-                        start = int(start_end[0]) if start_end[0] else 0
-                        end = int(start_end[1]) if start_end[1] else file_size - 1
-                        content_length = end - start + 1
-
-                        # Validate range
-                        if 0 <= start <= end < file_size:
-                            # Read file chunk
-                            with open(file_path, "rb") as f:
-                                f.seek(start)
-                                content = f.read(content_length)
-
-                            headers = {
-                                "Content-Type": "application/octet-stream",
-                                "Content-Length": str(content_length),
-                                "Content-Range": f"bytes {start}-{end}/{file_size}",
-                                "Accept-Ranges": "bytes",
-                                "ETag": etag,
-                                "Cache-Control": "public, max-age=3600",
-                            }
-
-                            return Response(
-                                content=content,
-                                status_code=206,  # Partial Content
-                                headers=headers,
-                            )
-            except (ValueError, OSError):
-                pass  # Fall back to full file
+        if if_none_match in (etag, etag + GZIP_ETAG_SUFFIX):
+            return Response(status_code=304, headers={"ETag": if_none_match})
+
+        # Handle Range requests (malformed ranges fall back to full file)
+        range_match = RANGE_RE.match(request.headers.get("range", ""))
+        if range_match and range_match.group(0) != "bytes=-":
+            start_spec, end_spec = range_match.groups()
+            if start_spec:
+                start = int(start_spec)
+                end = min(int(end_spec), file_size - 1) if end_spec else file_size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, file_size - int(end_spec))
+                end = file_size - 1
+
+            # Validate range
+            if 0 <= start <= end < file_size:
+                content_length = end - start + 1
+                headers = {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Length": str(content_length),
+                    "Content-Range": f"bytes {start}-{end}/{file_size}",
+                    "Accept-Ranges": "bytes",
+                    "ETag": etag,
+                    "Cache-Control": "public, max-age=3600",
+                }
+
+                # Stream the range without blocking the event loop
+                return StreamingResponse(
+                    iter_file_range(file_path, start, content_length),
+                    status_code=206,  # Partial Content
+                    headers=headers,
+                )
 
         # Serve full file with caching headers
         headers = {
             "Accept-Ranges": "bytes",
             "ETag": etag,
             "Cache-Control": "public, max-age=3600",
-            "Last-Modified": last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Last-Modified": last_modified,
         }
 
         return FileResponse(str(file_path), headers=headers)
@@ -322,14 +524,6 @@ async def proxy_api_routes(request: Request, path: str = ""):
     """Proxy API routes to backend"""
     logger.info(f"Proxying API: {request.method} {request.url}")
 
-    # Update metrics if available
-    if _prometheus_available and _request_count:
-        _request_count.labels(
-            method=request.method,
-            endpoint=f"/api/{path}",
-            status_code="200",  # Will be updated in middleware
-        ).inc()
-
     return await proxy_request(request, f"api/{path}")
 
 
@@ -395,12 +589,65 @@ async def server_info():
             "/api/*": "Proxy to backend API",
             "/*": "Static files with ETag & Range support",
         },
-        "quick_start": "Use hypercorn for HTTP/2: hypercorn start_production_working:app --bind 0.0.0.0:8080 --workers 4",
+        "quick_start": "Use hypercorn for HTTP/2: python start_production_working.py --http2",
     }
 
 
+def run_hypercorn(certfile: Optional[Path] = None, keyfile: Optional[Path] = None):
+    """Serve with Hypercorn: HTTP/2 via TLS ALPN, or h2c only without certs"""
+    from hypercorn.config import Config
+    from hypercorn.run import run
+
+    config = Config.from_mapping(
+        application_path="start_production_working:app",
+        bind=[f"{HOST}:{PORT}"],
+        workers=WORKERS,
+        worker_class="uvloop" if os.name == "posix" else "asyncio",
+        alpn_protocols=["h2", "http/1.1"],
+    )
+    if certfile and keyfile:
+        config.certfile = str(certfile)
+        config.keyfile = str(keyfile)
+    else:
+        logger.warning(
+            "No TLS certificate: HTTP/2 only via h2c prior knowledge, "
+            "browsers will use HTTP/1.1"
+        )
+    run(config)
+
+
 def main():
     """Start production server with all features"""
+    parser = argparse.ArgumentParser(description="FastAPI Security Proxy")
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Serve with Hypercorn for HTTP/2 (default: uvicorn, HTTP/1.1)",
+    )
+    parser.add_argument(
+        "--certfile",
+        type=Path,
+        default=SSL_CERT_FILE,
+        help=f"TLS certificate for --http2 (default: {SSL_CERT_FILE})",
+    )
+    parser.add_argument(
+        "--keyfile",
+        type=Path,
+        default=SSL_KEY_FILE,
+        help=f"TLS private key for --http2 (default: {SSL_KEY_FILE})",
+    )
+    args = parser.parse_args()
+
+    # Browsers only negotiate HTTP/2 over TLS (ALPN), never over h2c
+    tls = args.http2 and args.certfile.is_file() and args.keyfile.is_file()
+    base_url = f"{'https' if tls else 'http'}://localhost:{PORT}"
+    if not args.http2:
+        http2_status = " (start with --http2)"
+    elif tls:
+        http2_status = " ✅ (TLS + ALPN)"
+    else:
+        http2_status = f" ⚠️  h2c only (browsers need {args.certfile}, {args.keyfile})"
+
     try:
         print("🚀 FastAPI Security Proxy - Production Ready")
         print("=" * 50)
@@ -411,10 +658,11 @@ def main():
         print(f"Backend Proxy: {TARGET_SERVER}")
         print("")
         print("✅ Production Features:")
-        print("  • HTTP/2 Ready (use hypercorn for HTTP/2)")
+        print("  • HTTP/2" + http2_status)
         print("  • ETag Caching & Validation")
         print("  • Range Request Support")
         print("  • Security Headers (HSTS, CSP, X-Frame-Options)")
+        print("  • GZip Response Compression")
         print(
             "  • Prometheus Metrics"
             + (" ✅" if _prometheus_available else " ❌ (install prometheus-client)")
@@ -423,30 +671,35 @@ def main():
         print("  • Docker & Container Ready")
         print("")
         print("🌐 Access Points:")
-        print("  Main:      http://localhost:8080")
-        print("  Health:    http://localhost:8080/health")
-        print("  Docs:      http://localhost:8080/docs")
+        print(f"  Main:      {base_url}")
+        print(f"  Health:    {base_url}/health")
+        print(f"  Docs:      {base_url}/docs")
         print(
-            "  Metrics:   http://localhost:8080/metrics"
+            f"  Metrics:   {base_url}/metrics"
             + (" ✅" if _prometheus_available else "")
         )
         print("")
-        print(
-            "💡 For HTTP/2: hypercorn start_production_working:app --bind 0.0.0.0:8080"
-        )
         print("Press Ctrl+C to stop the server")
         print("=" * 50)
 
-        # Start with production optimizations
+        if args.http2:
+            if tls:
+                run_hypercorn(args.certfile, args.keyfile)
+            else:
+                run_hypercorn()
+            return
+
+        # Start with production optimizations ("auto" picks uvloop and
+        # httptools when installed, asyncio and h11 otherwise, e.g. Windows)
         uvicorn.run(
             "start_production_working:app",
             host=HOST,
             port=PORT,
             workers=WORKERS,
-            loop="asyncio",
-            access_log=True,
-            proxy_headers=True,
-            forwarded_allow_ips="*",
+            loop="auto",
+            http="auto",
+            access_log=False,
+            proxy_headers=False,
             timeout_keep_alive=5,
         )
 
@@ -7,11 +7,12 @@ Basic functionality test without complex dependencies
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
+from app.asgi_security import BASIC_SECURITY_HEADERS, SecurityHeadersASGIMiddleware
+from app.etag import etag_hash
 from fastapi.responses import FileResponse, Response
 from pathlib import Path
 import httpx
 import logging
-import hashlib
 from datetime import datetime
 
 # Configure logging
@@ -31,6 +32,7 @@ app = FastAPI(
 TARGET_SERVER = "http://127.0.0.1:8097"
 STATIC_ROOT = Path("data/htdocs")
 STATIC_ROOT.mkdir(parents=True, exist_ok=True)
+HOP_HEADERS = frozenset((b"host", b"content-length", b"connection", b"keep-alive"))
 
 # Create test static file if it doesn't exist
 test_file = STATIC_ROOT / "index.html"
@@ -63,23 +65,7 @@ app.mount("/static", StaticFiles(directory=str(STATIC_ROOT), html=True), name="s
 
 
 # Security headers middleware
-@app.middleware("http")
-async def add_security_headers(request: Request, call_next):
-    response = await call_next(request)
-
-    # Add security headers
-    security_headers = {
-        "X-Frame-Options": "DENY",
-        "X-Content-Type-Options": "nosniff",
-        "X-XSS-Protection": "1; mode=block",
-        "Referrer-Policy": "strict-origin-when-cross-origin",
-        "Permissions-Policy": "camera=(), microphone=(), geolocation=()",
-    }
-
-    for header, value in security_headers.items():
-        response.headers[header] = value
-
-    return response
+app.add_middleware(SecurityHeadersASGIMiddleware, headers=BASIC_SECURITY_HEADERS)
 
 
 async def proxy_request(request: Request, path: str = ""):
@@ -91,10 +77,8 @@ async def proxy_request(request: Request, path: str = ""):
         else:
             target_url = TARGET_SERVER
 
-        # Prepare headers
-        headers = dict(request.headers)
-        headers.pop("host", None)
-        headers.pop("content-length", None)
+        # Prepare headers (raw byte pairs, minus hop-by-hop headers)
+        headers = [(k, v) for k, v in request.headers.raw if k not in HOP_HEADERS]
 
         # Read request body
         body = await request.body()
@@ -144,7 +128,7 @@ async def serve_static_files(request: Request, filename: str = ""):
         # Generate ETag
         stat = file_path.stat()
         etag_content = f"{file_path.name}-{stat.st_mtime}-{stat.st_size}"
-        etag = hashlib.md5(etag_content.encode()).hexdigest()
+        etag = etag_hash(etag_content)
 
         # Check If-None-Match
         if_none_match = request.headers.get("if-none-match")
@@ -215,7 +199,7 @@ def main():
         print("Docs: http://localhost:8080/docs")
         print("Press Ctrl+C to stop the server")
 
-        uvicorn.run(app, host="0.0.0.0", port=8080, log_level="info", access_log=True)
+        uvicorn.run(app, host="0.0.0.0", port=8080, log_level="info", access_log=False)
 
     except KeyboardInterrupt:
         print("\nServer stopped by user")